@@ -190,6 +190,10 @@ class LoggerManager:
         """Stop the logging listener."""
         self.listener.stop()
 
+    def flush(self):
+        """Wait until the logging listener has written every queued log message."""
+        self.log_queue.join()
+
     def print_list_as_rich_table(self, data_list: list, title: str, headers=None):
         """Display a list of dictionaries in a rich table format."""
         if not data_list or not all(isinstance(item, dict) for item in data_list):
@@ -17,53 +17,75 @@ __author__ = "Trevor Maco <tmaco@cisco.com>"
 __copyright__ = "Copyright (c) 2024 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
+import argparse
+import asyncio
+import cProfile
 import csv
+import io
+import pstats
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from operator import itemgetter
 
 from rich.prompt import Confirm
 
 from config.config import c
 from logger.logrr import lm
-from meraki_api import meraki_api
+from meraki_api import MERAKI_API
 
 
-def translate_cidr_to_objects(cidr: str) -> str:
+def read_csv(file_path: str) -> tuple[list[str], list[list[str]]]:
     """
-    If CIDR string is a Policy Object or Policy Group Object, translate to the compatible format for L3 Rules
-    :param cidr: Cidr string (normal cidr, policy object name, policy group object name)
-    :return: Compatible cidr format for L3 Rules (if necessary, else return original cidr)
+    Read CSV file into its header and rows (blank lines skipped, empty file returns no header and no rows)
+    :param file_path: Path to CSV file
+    :return: Header (column names), Rows (list of column values)
     """
-    if cidr in meraki_api.policy_objects_name_to_id:
-        # Policy Object
-        obj_id = meraki_api.policy_objects_name_to_id[cidr]
-        return f"OBJ({obj_id})"
-    elif cidr in meraki_api.policy_group_objects_name_to_id:
-        # Policy Group Object
-        obj_id = meraki_api.policy_group_objects_name_to_id[cidr]
-        return f"GRP({obj_id})"
-    else:
-        # Normal Cidr
-        return cidr
+    with open(file_path, mode='r', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        rows = [row for row in reader if row]
+    return header, rows
+
+
+def get_cidr_map(meraki_api: MERAKI_API) -> dict[str, str]:
+    """
+    Build a mapping of Policy Object and Policy Group Object names to the compatible format for L3 Rules
+    (call after objects/groups are created, so new names are included)
+    :param meraki_api: Meraki API instance
+    :return: Dictionary of object name to compatible cidr format (normal cidrs are not in the mapping)
+    """
+    # Groups first, so a Policy Object takes precedence if a name is used by both
+    cidr_map = {name: f"GRP({obj_id})" for name, obj_id in meraki_api.policy_group_objects_name_to_id.items()}
+    cidr_map.update({name: f"OBJ({obj_id})" for name, obj_id in meraki_api.policy_objects_name_to_id.items()})
+    return cidr_map
+
+
+# L3 Rule fields that identify a duplicate rule (C-level fetch of all fields at once)
+_rule_key_getter = itemgetter('policy', 'protocol', 'srcCidr', 'destCidr', 'srcPort', 'destPort')
+
 
+def key_extractor(rule: dict) -> tuple[str, ...]:
+    """
+    Extract key fields from L3 Rule into a (lowercase) tuple. Lowercasing is required: the dashboard returns
+    mixed case values (ex: 'Any') and CSV values are user provided
+    :param rule: L3 Rule
+    :return: Tuple of key fields
+    """
+    return tuple(map(str.lower, _rule_key_getter(rule)))
 
-def combine_lists(existing_rules: list[dict], new_rules: list[dict]) -> list[dict]:
+
+def combine_lists(existing_rules: list[dict], new_rules: list[dict], new_keys: list[tuple]) -> list[dict]:
     """
     Combine two lists of L3 Rules, eliminating duplicates
     :param existing_rules: Existing L3 Rules
     :param new_rules: New L3 Rules
+    :param new_keys: Pre-computed key tuples of new_rules (same order, see key_extractor)
     :return: Combined list of L3 Rules
     """
-    key_fields = ['policy', 'protocol', 'srcCidr', 'destCidr', 'srcPort', 'destPort']
     combined_list = []
     seen = set()
 
-    # Helper function to extract key fields into a tuple
-    def key_extractor(dic):
-        """
-        Extract key fields from dictionary into a tuple
-        """
-        return tuple(dic[key].lower() for key in key_fields)
-
     # First process existing_rules, which these rules will be kept (ignore default rule)
     for rule in existing_rules:
         key_tuple = key_extractor(rule)
@@ -76,8 +98,7 @@ def combine_lists(existing_rules: list[dict], new_rules: list[dict]) -> list[dic
         combined_list.append(rule)
 
     # Then process new rules, only adding items not seen in existing_rules
-    for rule in new_rules:
-        key_tuple = key_extractor(rule)
+    for rule, key_tuple in zip(new_rules, new_keys):
         if key_tuple not in seen:
             seen.add(key_tuple)
             combined_list.append(rule)
@@ -85,74 +106,203 @@ def combine_lists(existing_rules: list[dict], new_rules: list[dict]) -> list[dic
     return combined_list
 
 
-def main():
+async def _bulk_create(meraki_api: MERAKI_API,
+                       policy_objects: list[dict]) -> list[tuple[dict, str | None, dict | str]]:
+    """
+    Create Policy Objects concurrently (at most 10 in flight), return results for logging in the main thread
+    :param meraki_api: Meraki API instance
+    :param policy_objects: List of Create Policy Object payloads
+    :return: List of Policy Object payload, Error Code (if relevant), Response (or Error Message)
+    """
+    semaphore = asyncio.Semaphore(10)
+
+    async with meraki_api.get_aio_dashboard() as aio_dashboard:
+        async def create(policy_object: dict) -> tuple[dict, str | None, dict | str]:
+            async with semaphore:
+                error, response = await meraki_api.create_policy_objects_async(aio_dashboard, policy_object)
+                return policy_object, error, response
+
+        return await asyncio.gather(*(create(policy_object) for policy_object in policy_objects))
+
+
+def _apply_rules(meraki_api: MERAKI_API, network: dict, overwrite: bool, l3_rules: list[dict],
+                 new_keys: list[tuple] | None) -> tuple[dict, str, str | None, dict | str]:
+    """
+    Apply L3 Rules to a single network (runs in a worker thread), return result for logging in the main thread
+    :param meraki_api: Meraki API instance
+    :param network: Network to apply L3 Rules to
+    :param overwrite: Overwrite existing L3 Rules (or merge with them)
+    :param l3_rules: New L3 Rules
+    :param new_keys: Pre-computed key tuples of l3_rules (None if overwriting)
+    :return: Network, Failed Step, Error Code (if relevant), Response (or Error Message)
+    """
+    network_id = network['id']
+    merged = l3_rules
+
+    if not overwrite:
+        # Combine existing rules with rules we added in (eliminate duplicates) if not overwriting
+        error, response = meraki_api.get_l3_outbound_rules(network_id)
+
+        if error:
+            return network, "get", error, response
+
+        # Per network result, l3_rules is shared by every network and must not absorb this network's rules
+        existing_rules = response['rules']
+        merged = combine_lists(existing_rules, l3_rules, new_keys)
+
+    error, response = meraki_api.update_l3_outbound_rules(network_id, merged)
+    return network, "update", error, response
+
+
+@contextmanager
+def profile_stage(name: str, stage_times: dict[str, tuple[float, float, float]], profiler: cProfile.Profile | None):
+    """
+    Time a stage of main() (wall, cpu and Meraki API time) and profile it with cProfile, no-op if profiling is disabled
+    :param name: Stage name
+    :param stage_times: Dictionary of stage name to (wall seconds, cpu seconds, http seconds), updated in place
+    :param profiler: cProfile instance (None if profiling is disabled)
+    """
+    if profiler is None:
+        yield
+        return
+
+    wall_start, cpu_start, http_start = time.perf_counter(), time.process_time(), MERAKI_API.api_time_total()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stage_times[name] = (time.perf_counter() - wall_start, time.process_time() - cpu_start,
+                             MERAKI_API.api_time_total() - http_start)
+
+
+def print_profile(stage_times: dict[str, tuple[float, float, float]], profiler: cProfile.Profile):
+    """
+    Print profiling results: wall vs cpu vs Meraki API time per stage, time per API operation, main thread cProfile
+    :param stage_times: Dictionary of stage name to (wall seconds, cpu seconds, http seconds)
+    :param profiler: cProfile instance
+    """
+    lm.flush()  # Step results are logged through the log queue, print them before the report
+    lm.p_panel(f"Profiling Results", title="Profile")
+
+    # HTTP time is summed across concurrent calls, so it can exceed wall time in concurrent stages
+    stage_rows = [{"Stage": name, "Wall (s)": f"{wall:.3f}", "CPU (s)": f"{cpu:.3f}", "HTTP (s)": f"{http:.3f}"}
+                  for name, (wall, cpu, http) in stage_times.items()]
+    lm.print_list_as_rich_table(stage_rows, title="Stages")
+
+    api_rows = [{"Operation": operation, "Calls": count, "Total (s)": f"{total:.3f}",
+                 "Avg (s)": f"{total / count:.3f}"}
+                for operation, (count, total) in sorted(MERAKI_API.api_stats.items(), key=lambda x: -x[1][1])]
+    if api_rows:
+        lm.print_list_as_rich_table(api_rows, title="Meraki API Calls (all threads)")
+
+    # Main thread only: calls made in worker threads only show up as lock/wait time here
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(15)
+    lm.tsp("cProfile, main thread only (worker thread API calls appear as lock/wait time, see Meraki API Calls)")
+    lm.tsp(stream.getvalue(), markup=False, highlight=False, soft_wrap=True)
+
+    wall_time = sum(wall for wall, _, _ in stage_times.values())
+    time_in_python = sum(cpu for _, cpu, _ in stage_times.values())
+    time_in_http = sum(http for _, _, http in stage_times.values())
+    lm.lnp(f"Profiled stages: wall {wall_time:.3f}s, time_in_http {time_in_http:.3f}s, "
+           f"time_in_python (cpu) {time_in_python:.3f}s", "info")
+
+
+def main(profile: bool = False):
     """
     Main Function, create policy objects, policy object groups, apply L3 Outbound Rules to all networks
+    :param profile: Time and profile object creation and L3 Rule application, print results at the end
     :return:
     """
     lm.print_start_panel(app_name=c.APP_NAME)  # Print the start info message to console
     lm.print_config_table(config_instance=c)  # Print the config table
 
-    # Read in CSV of policy objects/groups, create objects and groups
+    profiler = None
+    stage_times = {}
+    if profile:
+        profiler = cProfile.Profile()
+        MERAKI_API.enable_api_stats()
+
+    # Read in CSV of policy objects/groups (before any Meraki API calls, a missing file exits right away)
     try:
-        with open('policy_objects.csv', mode='r') as file:
-            reader = csv.DictReader(file)
-            policy_objects = list(reader)
+        header, rows = read_csv('policy_objects.csv')
+        policy_objects = [dict(zip(header, row)) for row in rows]
         lm.lnp(f"Read in {len(policy_objects)} Policy Objects", "success")
     except FileNotFoundError as e:
         lm.print_error(f"Policy Object File Not Found: {e}")
         return
 
-    lm.p_panel(f"Create Policy Objects and Policy Groups", title="Step 1")
-    for policy_object in policy_objects:
-        # Group Name Provided, create or use existing group
-        if "_group_name" in policy_object and policy_object["_group_name"] != '':
-            # Group doesn't exist, create it!
-            if not policy_object["_group_name"] in meraki_api.policy_group_objects_name_to_id:
-                group_payload = {"name": policy_object["_group_name"], "category": "NetworkObjectGroup"}
-                error, response = meraki_api.create_policy_object_groups(group_payload)
+    # Read in CSV of L3 Rules
+    try:
+        l3_header, l3_rows = read_csv('l3_outbound_rules.csv')
+        lm.lnp(f"Read in {len(l3_rows)} L3 Rules", "success")
+    except FileNotFoundError as e:
+        lm.print_error(f"L3 Outbound File Not Found: {e}")
+        return
 
+    # Load existing Policy Objects/Groups from Meraki (first access creates the Singleton instance)
+    with profile_stage("Load Inventory", stage_times, profiler):
+        meraki_api = MERAKI_API.get_instance()
+
+    lm.p_panel(f"Create Policy Objects and Policy Groups", title="Step 1")
+    with profile_stage("Create Policy Objects/Groups", stage_times, profiler):
+        # Create missing Policy Object Groups first (concurrently), objects depend on the group id
+        needed_groups = {obj["_group_name"] for obj in policy_objects if obj.get("_group_name")}
+        missing_groups = [name for name in needed_groups if name not in meraki_api.policy_group_objects_name_to_id]
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            futures = {executor.submit(meraki_api.create_policy_object_groups,
+                                       {"name": group_name, "category": "NetworkObjectGroup"}): group_name
+                       for group_name in missing_groups}
+
+            for future in as_completed(futures):
+                error, response = future.result()
                 if error:
-                    # Group creation error, skip creating policy object
-                    lm.lnp(f"Error Creating Policy Object Group `{policy_object["_group_name"]}`: {error} - {response}",
-                           "error")
-                    continue
+                    lm.lnp(f"Error Creating Policy Object Group `{futures[future]}`: {error} - {response}", "error")
                 else:
                     lm.lnp(f"Created Policy Object Group: {response}", "success")
 
-            # Obtain group id, associate new policy object with it
-            group_name = policy_object["_group_name"]
+        to_create = []
+        for policy_object in policy_objects:
+            # Group Name Provided, associate new policy object with the group
+            group_name = policy_object.pop("_group_name", '')
+            if group_name:
+                group_id = meraki_api.policy_group_objects_name_to_id.get(group_name)
 
-            del policy_object["_group_name"]
-            policy_object["groupIds"] = [meraki_api.policy_group_objects_name_to_id[group_name]]
+                if group_id is None:
+                    # Group creation error, skip creating policy object
+                    lm.lnp(f"Skipping Policy Object `{policy_object['name']}`: Policy Object Group `{group_name}` "
+                           f"not available", "error")
+                    continue
 
-        # Create Policy Object
-        error, response = meraki_api.create_policy_objects(policy_object)
-        if error:
-            lm.lnp(f"Error Creating Policy Object `{policy_object['name']}`: {error} - {response}", "error")
-        else:
-            lm.lnp(f"Created Policy Object: {response}", "success")
+                policy_object["groupIds"] = [group_id]
 
-    # Read in CSV of L3 Rules
-    try:
-        with open('l3_outbound_rules.csv', mode='r') as file:
-            reader = csv.DictReader(file)
-            l3_rules = list(reader)
-        lm.lnp(f"Read in {len(l3_rules)} L3 Rules", "success")
-    except FileNotFoundError as e:
-        lm.print_error(f"L3 Outbound File Not Found: {e}")
-        return
+            to_create.append(policy_object)
+
+        # Create Policy Objects concurrently
+        for policy_object, error, response in asyncio.run(_bulk_create(meraki_api, to_create)):
+            if error:
+                lm.lnp(f"Error Creating Policy Object `{policy_object['name']}`: {error} - {response}", "error")
+            else:
+                lm.lnp(f"Created Policy Object: {response}", "success")
 
     # Translate any src or dst usage of policy object or policy group object into compatible format
-    for rule in l3_rules:
-        # Source/Dest for Rule
-        rule['srcCidr'] = translate_cidr_to_objects(rule['srcCidr'])
-        rule['destCidr'] = translate_cidr_to_objects(rule['destCidr'])
+    cidr_map = get_cidr_map(meraki_api)
+    cidr_columns = [i for i, column in enumerate(l3_header) if column in ('srcCidr', 'destCidr')]
+    for row in l3_rows:
+        # Source/Dest for Rule (normal cidrs are kept as is)
+        for i in cidr_columns:
+            row[i] = cidr_map.get(row[i], row[i])
+
+    # Build L3 Rule payloads once, shared by every network
+    l3_rules = [dict(zip(l3_header, row)) for row in l3_rows]
 
     lm.p_panel(f"Create L3 Outbound Rules for All Networks", title="Step 2")
 
     # Get All Networks
-    error, response = meraki_api.get_org_appliance_networks()
+    with profile_stage("Get Networks", stage_times, profiler):
+        error, response = meraki_api.get_org_appliance_networks()
     if error:
         lm.lnp(f"Error getting org networks: {error} - {response}", "error")
     else:
@@ -161,27 +311,35 @@ def main():
     time.sleep(1)
     overwrite = Confirm.ask("Overwrite each Networks Existing L3 Rules?", default=False)
 
-    # Apply L3 Rules to each network
-    for network in response:
-        network_id = network['id']
+    # Rule keys are the same for every network, compute them once (only needed when merging, optional fields
+    # like srcPort/destPort may be missing from the CSV when overwriting)
+    new_keys = [key_extractor(rule) for rule in l3_rules] if not overwrite else None
 
-        if not overwrite:
-            # Combine existing rules with rules we added in (eliminate duplicates) if not overwriting
-            error, response = meraki_api.get_l3_outbound_rules(network_id)
+    with profile_stage("Apply L3 Rules", stage_times, profiler):
+        # Apply L3 Rules to each network (concurrently, paced by the MERAKI_API token bucket limiter)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            futures = [executor.submit(_apply_rules, meraki_api, network, overwrite, l3_rules, new_keys)
+                       for network in response]
 
-            if error:
-                lm.lnp(f"Error getting existing L3 Rules for `{network['name']}`: {error} - {response}", "error")
-                continue
+            # Log from the main thread as results arrive
+            for future in as_completed(futures):
+                network, step, error, response = future.result()
 
-            existing_rules = response['rules']
-            l3_rules = combine_lists(existing_rules, l3_rules)
+                if step == "get" and error:
+                    lm.lnp(f"Error getting existing L3 Rules for `{network['name']}`: {error} - {response}", "error")
+                elif error:
+                    lm.lnp(f"Error applying L3 Rules to Network `{network['name']}`: {error} - {response}", "error")
+                else:
+                    lm.lnp(f"Successfully applied L3 Rules to Network `{network['name']}`: {response}", "success")
 
-        error, response = meraki_api.update_l3_outbound_rules(network_id, l3_rules)
-        if error:
-            lm.lnp(f"Error applying L3 Rules to Network `{network['name']}`: {error} - {response}", "error")
-        else:
-            lm.lnp(f"Successfully applied L3 Rules to Network `{network['name']}`: {response}", "success")
+    if profiler:
+        print_profile(stage_times, profiler)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=c.APP_NAME)
+    parser.add_argument('--profile', action='store_true',
+                        help="Print wall/cpu/http time per stage, Meraki API call times, and a cProfile summary")
+    args = parser.parse_args()
+
+    main(profile=args.profile)
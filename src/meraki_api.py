@@ -17,18 +17,82 @@ __author__ = "Trevor Maco <tmaco@cisco.com>"
 __copyright__ = "Copyright (c) 2024 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 from typing import ClassVar, Optional
 
 import meraki
+import meraki.aio
 
 from config.config import c
 
 
+class RateLimiter(object):
+    """
+    Token Bucket Rate Limiter, proactively spaces out API calls to stay under the Meraki org rate limit
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        """
+        Initialize the token bucket (starts full)
+        :param rate: Tokens (requests) added per second
+        :param capacity: Maximum burst size (defaults to rate)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.available_request_capacity = self.capacity
+        self.last_update_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Refill the bucket, reserve a token for the caller
+        :return: Seconds the caller must wait before dispatching its request
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.last_update_time
+            self.available_request_capacity = min(self.capacity,
+                                                  self.available_request_capacity + elapsed * self.rate)
+            self.last_update_time = now
+
+            # Token taken up front, a negative balance queues later callers behind this one
+            self.available_request_capacity -= 1
+            if self.available_request_capacity >= 0:
+                return 0.0
+            return -self.available_request_capacity / self.rate
+
+    def __enter__(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    async def __aenter__(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
 class MERAKI_API(object):
     """
     Meraki API Class, includes various methods to interact with Meraki API
     """
     _instance: ClassVar[Optional['MERAKI_API']] = None
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    # Operation name -> [call count, cumulative seconds] of dashboard calls, None unless enabled (--profile in main)
+    api_stats: ClassVar[Optional[dict[str, list]]] = None
+    _stats_lock: ClassVar[threading.Lock] = threading.Lock()
 
     def __init__(self):
         """
@@ -36,21 +100,90 @@ class MERAKI_API(object):
         """
         self.org_id = c.ORG_ID
         self.retry_429_count = 25
+        self.requests_per_second = 9  # Stay just under the 10 req/s Meraki org limit
+        self._limiter = RateLimiter(self.requests_per_second)
+
         self.dashboard = meraki.DashboardAPI(api_key=c.MERAKI_API_KEY, suppress_logging=True,
                                              caller=c.APP_NAME, maximum_retries=self.retry_429_count)
 
-        # Get Current Policy Objects, create name to id mapping
-        self._policy_objects_name_to_id = {}
-        policy_objects = self.dashboard.organizations.getOrganizationPolicyObjects(self.org_id, total_pages='all')
-        for policy_object in policy_objects:
-            self._policy_objects_name_to_id[policy_object['name']] = policy_object['id']
+        # Note: the SDK fetches total_pages='all' one request per page, but the limiter only takes one token per
+        # call, so these startup calls are under-counted on orgs large enough to need several pages
+
+        # Get Current Policy Objects, create name to id mapping (perPage 5000: max and SDK default)
+        with self._api_call('getOrganizationPolicyObjects'):
+            policy_objects = self.dashboard.organizations.getOrganizationPolicyObjects(self.org_id, total_pages='all',
+                                                                                       perPage=5000)
+        self._policy_objects_name_to_id = {obj['name']: obj['id'] for obj in policy_objects}
+
+        # Get Current Policy Objects Groups, create name to id mapping (perPage 1000: max and SDK default)
+        with self._api_call('getOrganizationPolicyObjectsGroups'):
+            policy_object_groups = self.dashboard.organizations.getOrganizationPolicyObjectsGroups(self.org_id,
+                                                                                                   total_pages='all',
+                                                                                                   perPage=1000)
+        self._policy_group_objects_name_to_id = {group['name']: group['id'] for group in policy_object_groups}
+
+    @classmethod
+    def enable_api_stats(cls):
+        """
+        Record the duration of every following dashboard call in api_stats (excludes throttle waits)
+        """
+        cls.api_stats = {}
+
+    @classmethod
+    def api_time_total(cls) -> float:
+        """
+        Get the cumulative duration of all recorded dashboard calls (summed across concurrent calls)
+        :return: Total seconds (0 if api_stats is not enabled)
+        """
+        if cls.api_stats is None:
+            return 0.0
+        with cls._stats_lock:
+            return sum(total for _, total in cls.api_stats.values())
+
+    def _record_api_time(self, operation: str, elapsed: float):
+        """
+        Add a dashboard call's duration to api_stats
+        :param operation: Dashboard SDK operation name
+        :param elapsed: Call duration (seconds)
+        """
+        with self._stats_lock:
+            stats = self.api_stats.setdefault(operation, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+
+    @contextmanager
+    def _api_call(self, operation: str):
+        """
+        Throttle (token bucket) a dashboard call, time it if api_stats is enabled
+        :param operation: Dashboard SDK operation name
+        """
+        with self._limiter:
+            if self.api_stats is None:
+                yield
+                return
+
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._record_api_time(operation, time.perf_counter() - start)
+
+    @asynccontextmanager
+    async def _api_call_async(self, operation: str):
+        """
+        Throttle (token bucket) an async dashboard call, time it if api_stats is enabled
+        :param operation: Dashboard SDK operation name
+        """
+        async with self._limiter:
+            if self.api_stats is None:
+                yield
+                return
 
-        # Get Current Policy Objects Groups, create name to id mapping
-        self._policy_group_objects_name_to_id = {}
-        policy_object_groups = self.dashboard.organizations.getOrganizationPolicyObjectsGroups(self.org_id,
-                                                                                               total_pages='all')
-        for policy_object_group in policy_object_groups:
-            self._policy_group_objects_name_to_id[policy_object_group['name']] = policy_object_group['id']
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._record_api_time(operation, time.perf_counter() - start)
 
     @classmethod
     def get_instance(cls):
@@ -58,9 +191,10 @@ class MERAKI_API(object):
         Get Singleton instance of Meraki Class
         :return: Singleton instance of Meraki Class
         """
-        if cls._instance is None:
-            cls._instance = cls()
-        return cls._instance
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
 
     @property
     def policy_objects_name_to_id(self):
@@ -85,7 +219,8 @@ class MERAKI_API(object):
         :return: Error Code (if relevant), Response (or Error Message)
         """
         try:
-            response = self.dashboard.organizations.getOrganizationNetworks(self.org_id)
+            with self._api_call('getOrganizationNetworks'):
+                response = self.dashboard.organizations.getOrganizationNetworks(self.org_id)
             if len(c.NETWORK_NAMES) > 0:
                 appliance_networks = [network for network in response if
                                       'appliance' in network['productTypes'] and network['name'] in c.NETWORK_NAMES]
@@ -98,18 +233,30 @@ class MERAKI_API(object):
             # SDK Error
             return "500", str(e)
 
-    def create_policy_objects(self, policy_object_config: dict) -> tuple[str | None, dict | str]:
+    def get_aio_dashboard(self) -> meraki.aio.AsyncDashboardAPI:
         """
-        Create Network Policy Object, return response or (error code, error message)
+        Get an Async dashboard sdk instance (same settings as the sync instance), use as an async context manager
+        :return: Async dashboard sdk instance
+        """
+        return meraki.aio.AsyncDashboardAPI(api_key=c.MERAKI_API_KEY, suppress_logging=True, caller=c.APP_NAME,
+                                            maximum_retries=self.retry_429_count, maximum_concurrent_requests=10)
+
+    async def create_policy_objects_async(self, aio_dashboard: meraki.aio.AsyncDashboardAPI,
+                                          policy_object_config: dict) -> tuple[str | None, dict | str]:
+        """
+        Create Network Policy Object (async), return response or (error code, error message)
         https://developer.cisco.com/meraki/api-v1/create-organization-policy-object/
+        :param aio_dashboard: Async dashboard sdk instance
         :param policy_object_config: Create Policy Object payload
         :return: Error Code (if relevant), Response (or Error Message)
         """
         try:
-            response = self.dashboard.organizations.createOrganizationPolicyObject(self.org_id, **policy_object_config)
+            async with self._api_call_async('createOrganizationPolicyObject'):
+                response = await aio_dashboard.organizations.createOrganizationPolicyObject(self.org_id,
+                                                                                            **policy_object_config)
             self._policy_objects_name_to_id[policy_object_config['name']] = response['id']
             return None, response
-        except meraki.APIError as e:
+        except meraki.AsyncAPIError as e:
             return e.status, str(e)
         except Exception as e:
             # SDK Error
@@ -123,8 +270,9 @@ class MERAKI_API(object):
         :return: Error Code (if relevant), Response (or Error Message)
         """
         try:
-            response = self.dashboard.organizations.createOrganizationPolicyObjectsGroup(self.org_id,
-                                                                                         **policy_object_group_config)
+            with self._api_call('createOrganizationPolicyObjectsGroup'):
+                response = self.dashboard.organizations.createOrganizationPolicyObjectsGroup(
+                    self.org_id, **policy_object_group_config)
             self._policy_group_objects_name_to_id[policy_object_group_config['name']] = response['id']
             return None, response
         except meraki.APIError as e:
@@ -141,7 +289,8 @@ class MERAKI_API(object):
         :return: Error Code (if relevant), Response (or Error Message)
         """
         try:
-            response = self.dashboard.appliance.getNetworkApplianceFirewallL3FirewallRules(network_id)
+            with self._api_call('getNetworkApplianceFirewallL3FirewallRules'):
+                response = self.dashboard.appliance.getNetworkApplianceFirewallL3FirewallRules(network_id)
             return None, response
         except meraki.APIError as e:
             return e.status, str(e)
@@ -158,14 +307,12 @@ class MERAKI_API(object):
         :return: Error Code (if relevant), Response (or Error Message)
         """
         try:
-            response = self.dashboard.appliance.updateNetworkApplianceFirewallL3FirewallRules(networkId=network_id,
-                                                                                              rules=l3_rules_list)
+            with self._api_call('updateNetworkApplianceFirewallL3FirewallRules'):
+                response = self.dashboard.appliance.updateNetworkApplianceFirewallL3FirewallRules(
+                    networkId=network_id, rules=l3_rules_list)
             return None, response
         except meraki.APIError as e:
             return e.status, str(e)
         except Exception as e:
             # SDK Error
             return "500", str(e)
-
-
-meraki_api = MERAKI_API.get_instance()  # Singleton instance of MERAKI_API